@@ -2,7 +2,10 @@
 # Copyright 2020 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import copy
+import functools
 import hashlib
+import json
 import logging
 import traceback
 import yaml
@@ -21,6 +24,43 @@ CLUSTER_SETTINGS_URL = "http://{}/_cluster/settings"
 NODE_NAME = "{}-{}.{}-endpoints.{}.svc.cluster.local"
 SEED_SIZE = 3
 
+# use the libyaml C bindings when PyYAML has been built with them
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_text_file(path):
+    """Read a configuration file shipped with the charm
+
+    These files do not change while the charm is running, so they are
+    only read from disk once.
+    """
+    with open(path) as text_file:
+        return text_file.read()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_yaml_file(path):
+    """Parse a YAML configuration file shipped with the charm
+
+    The parsed object is shared between callers and must be copied
+    before it is modified.
+    """
+    return yaml.load(_load_text_file(path), Loader=_YAML_LOADER)
+
+
+@functools.lru_cache(maxsize=1)
+def _render_elasticsearch_config(cluster_name):
+    """Generate the content of elasticsearch.yml for a cluster name
+    """
+    elastic_config = copy.deepcopy(_load_yaml_file('config/elasticsearch.yml'))
+    elastic_config['cluster']['name'] = cluster_name
+
+    # a stable key order keeps the config hash from changing spuriously
+    return yaml.dump(elastic_config, Dumper=_YAML_DUMPER,
+                     default_flow_style=False, sort_keys=True)
+
 
 class ElasticsearchOperatorCharm(CharmBase):
     _stored = StoredState()
@@ -35,9 +75,16 @@ class ElasticsearchOperatorCharm(CharmBase):
         """
         super().__init__(*args)
 
+        # host name template with only the unit number left to fill in
+        self._host_name_template = NODE_NAME.format(self.meta.name,
+                                                    '{node_num}',
+                                                    self.meta.name,
+                                                    self.model.name)
+
         self.framework.observe(self.on.config_changed, self._on_config_changed)
         self.framework.observe(self.on.stop, self._on_stop)
         self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(self.on.leader_elected, self._on_leader_elected)
         self.framework.observe(
             self.on[PEER].relation_joined,
             self._on_elasticsearch_unit_joined
@@ -53,6 +100,19 @@ class ElasticsearchOperatorCharm(CharmBase):
 
         self._stored.set_default(nodes=[self._host_name(i)
                                         for i in range(SEED_SIZE)])
+        # fingerprint of the dynamic settings last known to be applied
+        # to the Elasticsearch cluster
+        self._stored.set_default(last_dynamic_settings='')
+        # fingerprint of the pod spec last set by this unit
+        self._stored.set_default(last_pod_hash='')
+        # (number of seed nodes, unicast_hosts.txt content) of the last
+        # _seed_hosts call
+        self._seed_hosts_cache = None
+        # Elasticsearch client shared by all requests made in this hook,
+        # and the host it was created for
+        self._es = None
+        self._es_host = None
+        self._ingress_address = None
 
     @property
     def num_hosts(self) -> int:
@@ -69,23 +129,28 @@ class ElasticsearchOperatorCharm(CharmBase):
         """
         es = self._get_es_client()
         try:
-            health = es.cat.health(format='json', h='node.total')
-            return int(health[0]['node.total'])
+            # the plain text response is just the node count
+            health = es.cat.health(h='node.total')
+            return int(health.strip())
         except RequestError:
             return 0
 
     @property
-    def current_minimum_master_nodes(self) -> int:
+    def current_minimum_master_nodes(self):
         """The current value of the discovery.zen.minimum_master_nodes cluster setting
 
-        Default to 1 if we cannot get the value.
+        Default to 1 if the setting is not set, and return None if the
+        cluster settings cannot be read.
         """
-        # attempt to get the settings of the cluster via the python module
+        # attempt to get the settings of the cluster via the python module,
+        # only asking Elasticsearch for the one setting that is needed
         es = self._get_es_client()
         try:
-            settings = es.cluster.get_settings()
+            settings = es.cluster.get_settings(
+                filter_path='persistent.discovery.zen.minimum_master_nodes')
         except RequestError:
-            return 1
+            logger.warning('Unable to read cluster settings')
+            return None
 
         # attempt to get the minimum_master_node setting from the nested dictionary
         try:
@@ -98,13 +163,19 @@ class ElasticsearchOperatorCharm(CharmBase):
     def ideal_minimum_master_nodes(self):
         """Returns the minimum master nodes setting based on total number of nodes
         """
-        return 1 if self.num_hosts <= 2 else self.num_hosts // 2 + 1
+        num_hosts = self.num_hosts
+        return 1 if num_hosts <= 2 else num_hosts // 2 + 1
 
     @property
     def ingress_address(self) -> str:
         """The ingress-address of the Elasticsearch cluster
+
+        The address does not change while a hook runs, so it is only
+        looked up once per charm instance.
         """
-        return str(self.model.get_binding(PEER).network.ingress_address)
+        if self._ingress_address is None:
+            self._ingress_address = str(self.model.get_binding(PEER).network.ingress_address)
+        return self._ingress_address
 
     def _on_config_changed(self, _):
         """Set a new Juju pod specification
@@ -114,8 +185,19 @@ class ElasticsearchOperatorCharm(CharmBase):
     def _on_update_status(self, _):
         """Update status event to take care of various cluster health checks
         """
-        # check to see if we need to update the dynamic settings
-        self._configure_dynamic_settings()
+        # check to see if we need to update the dynamic settings, always
+        # reading them from the cluster so that any drift is corrected
+        self._configure_dynamic_settings(check_cluster=True)
+
+    def _on_leader_elected(self, _):
+        """Forget the settings and pod spec recorded while this unit was last leader
+
+        Another leader may have changed the cluster in the meantime, so
+        the pod spec of this unit is set again.
+        """
+        self._stored.last_dynamic_settings = ''
+        self._stored.last_pod_hash = ''
+        self._configure_pod()
 
     def _on_stop(self, _):
         """Mark this unit as inactive
@@ -135,15 +217,19 @@ class ElasticsearchOperatorCharm(CharmBase):
             # only updated the list of seed nodes if there fewer than
             # the minimum specified by this charm
             if node_num < SEED_SIZE:
-                for i in range(SEED_SIZE - node_num):
-                    self._stored.nodes.append(self._host_name(i))
+                host_names = (self._host_name(i) for i in range(node_num, SEED_SIZE))
+                new_nodes = [host for host in host_names if host not in self._stored.nodes]
+                if new_nodes:
+                    self._stored.nodes.extend(new_nodes)
+                    # the new seed hosts only reach the pods through a new spec
+                    self._configure_pod()
 
     def _on_elasticsearch_relation_changed(self, _):
         """Reset Elasticsearch pod specification if changed
         """
-        if self.unit.is_leader():
-            logger.debug("Peer Node Names : {}".format(
-                list(self._stored.nodes)))
+        # only copy the stored node list when it is actually logged
+        if self.unit.is_leader() and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Peer Node Names : %s", list(self._stored.nodes))
         # The list of seed nodes changes only if there were fewer than
         # the minimum required. Hence a pod reconfiguration is only
         # necessary in such a case.
@@ -165,26 +251,38 @@ class ElasticsearchOperatorCharm(CharmBase):
     def _build_dynamic_settings_payload(self):
         """Construct payload of the cluster configuration settings that need updating
         """
-        dynamic_config = {
-            'persistent': {},
-            'transient': {},
-        }
+        # all settings managed by this charm are persistent ones
+        persistent = {}
 
-        # determine whether minimum_master_nodes setting needs to be updated
-        if self.ideal_minimum_master_nodes != self.current_minimum_master_nodes:
-            dynamic_config['persistent'].update({
-                'discovery.zen.minimum_master_nodes': self.ideal_minimum_master_nodes
-            })
+        # determine whether minimum_master_nodes setting needs to be updated,
+        # a setting that could not be read is always written
+        ideal_minimum_master_nodes = self.ideal_minimum_master_nodes
+        current_minimum_master_nodes = self.current_minimum_master_nodes
+        if current_minimum_master_nodes is None or \
+                ideal_minimum_master_nodes != current_minimum_master_nodes:
+            persistent['discovery.zen.minimum_master_nodes'] = ideal_minimum_master_nodes
 
         # check whether there have been any new settings that need changing
-        if not dynamic_config['persistent'] and not dynamic_config['transient']:
+        if not persistent:
             return None
         else:
-            return dynamic_config
+            return {'persistent': persistent}
 
-    def _get_es_client(self) -> Elasticsearch():
+    def _dynamic_settings_fingerprint(self) -> str:
+        """Serialized form of the dynamic settings this charm wants applied
+        """
+        return json.dumps({
+            'discovery.zen.minimum_master_nodes': self.ideal_minimum_master_nodes
+        }, sort_keys=True)
+
+    def _get_es_client(self) -> Elasticsearch:
         """Return an instance of the Elasticsearch Python client
 
+        The client is created on first use and then reused, so that all
+        requests made while handling a hook share its connection pool. The
+        ingress address is fixed for the life of the charm instance, so a
+        new client is only created if the port changes.
+
         ES Python module docs:
         https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch
         """
@@ -194,16 +292,25 @@ class ElasticsearchOperatorCharm(CharmBase):
             self.ingress_address,
             self.model.config['port']
         )
+        if self._es is not None and host == self._es_host:
+            return self._es
 
         # TODO: if credentials are added to the config options, be sure to
         #       add them in the instantiation of the ES client
-        return Elasticsearch(host)
+        self._es = Elasticsearch(host)
+        self._es_host = host
+        return self._es
 
-    def _configure_dynamic_settings(self):
+    def _configure_dynamic_settings(self, check_cluster=False):
         """Use ES API to create dynamic config changes without pod resets
 
         A dynamic setting update cannot (and will not) take place if the number of units
         recognized by Juju does not match the number of nodes recognized by Elasticsearch
+
+        Unless check_cluster is set, the cluster settings are neither read
+        nor written while the desired settings are the same as those last
+        applied by this unit. They are only recorded as applied once they
+        have been read back unchanged or successfully written.
         """
         if self.num_hosts != self.num_es_nodes:
             self.unit.status = MaintenanceStatus('Waiting for nodes to join ES cluster')
@@ -212,8 +319,14 @@ class ElasticsearchOperatorCharm(CharmBase):
             self.unit.status = ActiveStatus()
             return
 
+        settings_key = self._dynamic_settings_fingerprint()
+        if not check_cluster and settings_key == self._stored.last_dynamic_settings:
+            self.unit.status = ActiveStatus()
+            return
+
         cluster_settings = self._build_dynamic_settings_payload()
         if cluster_settings is None:
+            self._stored.last_dynamic_settings = settings_key
             self.unit.status = ActiveStatus()
             return
 
@@ -222,6 +335,7 @@ class ElasticsearchOperatorCharm(CharmBase):
         try:
             logger.info('Attempting to configure dynamic settings.')
             es.cluster.put_settings(body=cluster_settings)
+            self._stored.last_dynamic_settings = settings_key
             self.unit.status = ActiveStatus()
         except RequestError:
             logger.error(traceback.format_exc())
@@ -232,51 +346,42 @@ class ElasticsearchOperatorCharm(CharmBase):
         """
         charm_config = self.model.config
 
-        with open('config/elasticsearch.yml') as yaml_file:
-            elastic_config = yaml.safe_load(yaml_file)
-
-        elastic_config['cluster']['name'] = charm_config['cluster-name']
-
-        return yaml.dump(elastic_config)
+        return _render_elasticsearch_config(charm_config['cluster-name'])
 
     def _jvm_config(self):
         """Construct Java Virtual Machine configuration for Elasticsearch
         """
-        with open('config/jvm.options') as text_file:
-            return text_file.read()
+        return _load_text_file('config/jvm.options')
 
     def _logging_config(self):
         """Construct the logging configuration for Elasticsearch
         """
-        with open('config/logging.yml') as yaml_file:
-            logging_config = yaml.safe_load(yaml_file)
-
-        return yaml.dump(logging_config)
+        return _load_text_file('config/logging.yml')
 
     def _log4j_config(self):
         """Construct the Log4J configuration for Elasticsearch
         """
-        with open('config/log4j2.properties') as text_file:
-            return text_file.read()
+        return _load_text_file('config/log4j2.properties')
 
     def _host_name(self, node_num):
         """Hostname of the nth Juju unit for this charm
         """
-        return NODE_NAME.format(self.meta.name,
-                                node_num,
-                                self.meta.name,
-                                self.model.name)
+        return self._host_name_template.format(node_num=node_num)
 
     def _seed_hosts(self):
         """Generate the list of seed host names
 
         This list is used to populate the unicast_hosts.txt file used by
-        Elasticsearch.
+        Elasticsearch. The list of seed nodes only ever grows, so the
+        generated content is reused until its length changes.
         """
-        seed_hosts = list(self._stored.nodes)
-        logger.debug('Seed Hosts : {}'.format(seed_hosts))
+        node_num = len(self._stored.nodes)
+        if self._seed_hosts_cache is None or self._seed_hosts_cache[0] != node_num:
+            seed_hosts = list(self._stored.nodes)
+            logger.debug('Seed Hosts : %s', seed_hosts)
+            self._seed_hosts_cache = (node_num, '\n'.join(seed_hosts))
 
-        return '\n'.join(seed_hosts)
+        return self._seed_hosts_cache[1]
 
     def _config_hash(self):
         """Fingerprint for an Elasticsearch configuration setup
@@ -288,56 +393,83 @@ class ElasticsearchOperatorCharm(CharmBase):
         indeed make Juju trigger the creation of pods using the
         updated configuration.
         """
-        config_string = self._seed_hosts() + self._elasticsearch_config() +\
-            self._jvm_config() + self._logging_config() + self._log4j_config()
+        return self._config_hash_from(self._seed_hosts(),
+                                      self._elasticsearch_config(),
+                                      self._jvm_config(),
+                                      self._logging_config(),
+                                      self._log4j_config())
 
-        return hashlib.md5(config_string.encode()).hexdigest()
+    def _config_hash_from(self, *config_contents):
+        """Fingerprint for already constructed configuration file contents
+
+        The contents are hashed in the order they are passed in.
+        """
+        # the hash is only used as a change fingerprint; blake2b is faster
+        # than md5 and, unlike md5, is not disabled on FIPS enabled hosts
+        config_hash = hashlib.blake2b(digest_size=16)
+        for content in config_contents:
+            config_hash.update(content.encode())
+
+        return config_hash.hexdigest()
 
     def _build_pod_spec(self):
         """Construct a Juju pod specification for Elasticsearch
         """
         logger.debug('Building Pod Spec')
         charm_config = self.model.config
+        image_path = charm_config['elasticsearch-image-path']
+        port = charm_config['port']
+
+        # each configuration file is only constructed once and shared
+        # between the hash and the volume configuration
+        seed_hosts = self._seed_hosts()
+        elastic_config = self._elasticsearch_config()
+        jvm_config = self._jvm_config()
+        logging_config = self._logging_config()
+        log4j_config = self._log4j_config()
+        config_hash = self._config_hash_from(seed_hosts, elastic_config, jvm_config,
+                                             logging_config, log4j_config)
+
         spec = {
             'version': 3,
             'containers': [{
                 'name': self.app.name,
                 'imageDetails': {
-                    'imagePath': charm_config['elasticsearch-image-path'],
+                    'imagePath': image_path,
                 },
                 'ports': [{
-                    'containerPort': charm_config['port'],
+                    'containerPort': port,
                     'protocol': 'TCP'
                 }],
                 'envConfig': {
                     'ES_PATH_CONF': '/etc/elasticsearch',
-                    'ES_CONFIG_HASH': self._config_hash()
+                    'ES_CONFIG_HASH': config_hash
                 },
                 'volumeConfig': [{
                     'name': 'config',
                     'mountPath': '/usr/share/elasticsearch/config',
                     'files': [{
                         'path': 'unicast_hosts.txt',
-                        'content': self._seed_hosts()
+                        'content': seed_hosts
                     }, {
                         'path': 'elasticsearch.yml',
-                        'content': self._elasticsearch_config()
+                        'content': elastic_config
                     }, {
                         'path': 'jvm.options',
-                        'content': self._jvm_config()
+                        'content': jvm_config
                     }, {
                         'path': 'logging.yml',
-                        'content': self._logging_config()
+                        'content': logging_config
                     }, {
                         'path': 'log4j2.properties',
-                        'content': self._log4j_config()
+                        'content': log4j_config
                     }]
                 }],
                 'kubernetes': {
                     'livenessProbe': {
                         'httpGet': {
                             'path': '/_cat/health?v',
-                            'port': charm_config['port']
+                            'port': port
                         },
                         'initialDelaySeconds': 20,
                         'timeoutSeconds': 20,
@@ -345,7 +477,7 @@ class ElasticsearchOperatorCharm(CharmBase):
                     'readinessProbe': {
                         'httpGet': {
                             'path': '/_cat/health?v',
-                            'port': charm_config['port']
+                            'port': port
                         },
                         'initialDelaySeconds': 10,
                         'timeoutSeconds': 10,
@@ -367,13 +499,33 @@ class ElasticsearchOperatorCharm(CharmBase):
                      'does not have to restart')
 
         logger.debug('Configuring Pod')
-        self.unit.status = MaintenanceStatus('Setting pod spec')
         pod_spec = self._build_pod_spec()
 
-        self.model.pod.set_spec(pod_spec)
-        self.app.status = ActiveStatus('Elasticsearch is ready')
+        # setting the pod spec is a round trip to the Juju controller,
+        # so avoid it if the specification has not changed
+        pod_spec_hash = self._pod_spec_hash(pod_spec)
+        if pod_spec_hash == self._stored.last_pod_hash:
+            logger.debug('Pod spec is unchanged')
+        else:
+            self.model.pod.set_spec(pod_spec)
+            self._stored.last_pod_hash = pod_spec_hash
+            self.app.status = ActiveStatus('Elasticsearch is ready')
+
+        # the unit status is only written once, setting the pod spec is
+        # too quick for an intermediate maintenance status to be useful
         self.unit.status = ActiveStatus()
 
+    def _pod_spec_hash(self, pod_spec):
+        """Fingerprint for a complete pod specification
+
+        The whole specification is hashed, rather than only the
+        configuration files, so that changes to the image, the port or
+        the spec layout of a newer charm revision are never skipped.
+        """
+        spec_string = json.dumps(pod_spec, sort_keys=True)
+
+        return hashlib.blake2b(spec_string.encode(), digest_size=16).hexdigest()
+
 
 if __name__ == "__main__":
     main(ElasticsearchOperatorCharm)
@@ -1,28 +1,48 @@
 # Copyright 2020 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import copy
+import functools
+import hashlib
+import pathlib
 import random
+import types
 import unittest
 import yaml
 
 from unittest import mock
 import elasticsearch  # noqa
+from elasticsearch.exceptions import RequestError
 
 import charm
-from ops.model import ActiveStatus, MaintenanceStatus
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
 from ops.testing import Harness
 from charm import ElasticsearchOperatorCharm
 
-MINIMAL_CONFIG = {
+# read-only so that no test can change the configuration used by others,
+# tests pass a copy or only the options they change to update_config
+MINIMAL_CONFIG = types.MappingProxyType({
     'elasticsearch-image-path': 'elastic',
     'cluster-name': 'elasticsearch',
     'port': 9200
-}
+})
+
+
+CHARM_DIR = pathlib.Path(charm.__file__).parent.parent
 
 
 class TestCharm(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # charm metadata and config options are the same for every test,
+        # so they are only read once instead of by each new Harness
+        cls.metadata = (CHARM_DIR / 'metadata.yaml').read_text()
+        cls.config_options = (CHARM_DIR / 'config.yaml').read_text()
+
     def setUp(self):
-        self.harness = Harness(ElasticsearchOperatorCharm)
+        self.harness = Harness(ElasticsearchOperatorCharm,
+                               meta=self.metadata,
+                               config=self.config_options)
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
 
@@ -45,14 +65,61 @@ class TestCharm(unittest.TestCase):
 
     def test_cluster_name_can_be_changed(self):
         self.harness.set_leader(True)
-        name_config = MINIMAL_CONFIG.copy()
-        name_config['cluster-name'] = 'new name'
+        name_config = {'cluster-name': 'new name'}
         self.harness.update_config(name_config)
         pod_spec, _ = self.harness.get_pod_spec()
         config = elastic_config(pod_spec)
         self.assertEqual(config['cluster']['name'],
                          name_config['cluster-name'])
 
+    def test_cluster_name_change_does_not_modify_cached_config(self):
+        self.harness.set_leader(True)
+        self.harness.update_config({'cluster-name': 'new name'})
+
+        # the parsed configuration file is shared between pod spec builds
+        base_config = charm._load_yaml_file('config/elasticsearch.yml')
+        self.assertEqual(base_config['cluster']['name'], 'elasticsearch')
+
+    def test_pod_spec_config_hash_matches_config_files(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(MINIMAL_CONFIG.copy())
+        pod_spec, _ = self.harness.get_pod_spec()
+        env_config = pod_spec['containers'][0]['envConfig']
+
+        # the hash covers the content of every file in the pod spec
+        config_hash = hashlib.blake2b(digest_size=16)
+        for obj in config_files(pod_spec).values():
+            config_hash.update(obj['content'].encode())
+        self.assertEqual(env_config['ES_CONFIG_HASH'], config_hash.hexdigest())
+
+    def test_pod_spec_is_only_set_when_changed(self):
+        self.harness.set_leader(True)
+        name_config = MINIMAL_CONFIG.copy()
+        self.harness.update_config(name_config)
+
+        with mock.patch.object(self.harness.charm.model.pod, 'set_spec') as mock_set_spec:
+            # an unchanged configuration does not set the pod spec again
+            self.harness.charm.on.config_changed.emit()
+            mock_set_spec.assert_not_called()
+
+            name_config['cluster-name'] = 'new name'
+            self.harness.update_config(name_config)
+            mock_set_spec.assert_called_once()
+
+    def test_pod_spec_is_set_after_regaining_leadership(self):
+        self.harness.set_leader(True)
+        self.harness.update_config(MINIMAL_CONFIG.copy())
+        pod_spec, _ = self.harness.get_pod_spec()
+
+        # stand in for another leader setting a different pod spec
+        other_spec = copy.deepcopy(pod_spec)
+        other_spec['containers'][0]['imageDetails']['imagePath'] = 'other'
+        self.harness.charm.model.pod.set_spec(other_spec)
+
+        self.harness.set_leader(False)
+        self.harness.set_leader(True)
+        self.assertEqual(self.harness.get_pod_spec()[0], pod_spec)
+
     def test_seed_nodes_are_added_when_fewer_than_minimum(self):
         self.harness.set_leader(True)
         seed_config = MINIMAL_CONFIG.copy()
@@ -60,24 +127,38 @@ class TestCharm(unittest.TestCase):
 
         # create a peer relation and add a peer unit
         rel_id = self.harness.add_relation('elasticsearch', 'elasticsearch')
-        self.assertIsInstance(rel_id, int)
         self.harness.add_relation_unit(rel_id, 'elasticsearch-operator-0')
 
         # check number of seed hosts is the default value
         pod_spec, _ = self.harness.get_pod_spec()
         seed_hosts_file = config_file(pod_spec, 'unicast_hosts.txt')
-        self.assertEqual(charm.SEED_SIZE, len(seed_hosts_file['content'].split("\n")))
+        self.assertEqual(charm.SEED_SIZE, seed_hosts_file['content'].count("\n") + 1)
 
         # increase number of seed hosts and add a unit to trigger the change
-        charm.SEED_SIZE = 4
-        self.harness.add_relation_unit(rel_id, 'elasticsearch-operator-1')
+        with mock.patch.object(charm, 'SEED_SIZE', 4):
+            self.harness.add_relation_unit(rel_id, 'elasticsearch-operator-1')
+
+            # check the number of seed hosts has now increased
+            pod_spec, _ = self.harness.get_pod_spec()
+            seed_hosts_file = config_file(pod_spec, 'unicast_hosts.txt')
+            self.assertEqual(charm.SEED_SIZE, 4)
+            self.assertEqual(charm.SEED_SIZE, seed_hosts_file['content'].count("\n") + 1)
+
+    def test_added_seed_nodes_are_unique(self):
+        self.harness.set_leader(True)
+        seed_config = MINIMAL_CONFIG.copy()
         self.harness.update_config(seed_config)
+        rel_id = self.harness.add_relation('elasticsearch', 'elasticsearch')
+
+        # grow the number of seed hosts so that a joining unit adds more of them
+        seed_size = len(self.harness.charm._stored.nodes) + 2
+        with mock.patch.object(charm, 'SEED_SIZE', seed_size):
+            self.harness.add_relation_unit(rel_id, 'elasticsearch-operator/1')
 
-        # check the number of seed hosts has now increased
         pod_spec, _ = self.harness.get_pod_spec()
-        seed_hosts_file = config_file(pod_spec, 'unicast_hosts.txt')
-        self.assertEqual(charm.SEED_SIZE, 4)
-        self.assertEqual(charm.SEED_SIZE, len(seed_hosts_file['content'].split("\n")))
+        seed_hosts = config_file(pod_spec, 'unicast_hosts.txt')['content'].split("\n")
+        expected_hosts = [self.harness.charm._host_name(i) for i in range(seed_size)]
+        self.assertEqual(expected_hosts, seed_hosts)
 
     def test_num_hosts_is_equal_to_num_units(self):
         self.harness.set_leader(True)
@@ -129,6 +210,12 @@ class TestCharm(unittest.TestCase):
         actual_mmn = payload['persistent']['discovery.zen.minimum_master_nodes']
         self.assertEqual(expected_mmn, actual_mmn)
 
+    def test_num_es_nodes_is_read_from_cat_health(self):
+        es = self.harness.charm._get_es_client()
+        es.cat.health.return_value = '3\n'
+        self.assertEqual(self.harness.charm.num_es_nodes, 3)
+        es.cat.health.assert_called_once_with(h='node.total')
+
     def test_peer_changed_handler_with_single_node_via_update_status_event(self):
         self.harness.set_leader(True)
         seed_config = MINIMAL_CONFIG.copy()
@@ -259,26 +346,155 @@ class TestCharm(unittest.TestCase):
                 ActiveStatus()
             )
 
+    @mock.patch('charm.ElasticsearchOperatorCharm.num_es_nodes', new_callable=mock.PropertyMock)
+    def test_unchanged_dynamic_settings_are_not_reapplied(self, mock_es_nodes):
+        self.harness.set_leader(True)
+        seed_config = MINIMAL_CONFIG.copy()
+        self.harness.update_config(seed_config)
+
+        num_units = 3
+        mock_es_nodes.return_value = num_units
+        rel_id = self.harness.add_relation('elasticsearch', 'elasticsearch')
+        for i in range(1, num_units):
+            self.harness.add_relation_unit(rel_id, 'elasticsearch-operator/{}'.format(i))
 
-def config_file(pod_spec, file):
+        # the update applies the settings, the relation change finds them unchanged
+        es = self.harness.charm._get_es_client()
+        self.harness.charm.on.update_status.emit()
+        rel = self.harness.model.get_relation('elasticsearch')
+        self.harness.charm.on.elasticsearch_relation_changed.emit(rel)
+        es.cluster.put_settings.assert_called_once()
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+    @mock.patch('charm.ElasticsearchOperatorCharm.current_minimum_master_nodes',
+                new_callable=mock.PropertyMock)
+    @mock.patch('charm.ElasticsearchOperatorCharm.num_es_nodes', new_callable=mock.PropertyMock)
+    def test_update_status_corrects_drifted_dynamic_settings(self, mock_es_nodes, mock_mmn):
+        self.harness.set_leader(True)
+        self.harness.update_config(MINIMAL_CONFIG.copy())
+
+        num_units = 3
+        mock_es_nodes.return_value = num_units
+        rel_id = self.harness.add_relation('elasticsearch', 'elasticsearch')
+        for i in range(1, num_units):
+            self.harness.add_relation_unit(rel_id, 'elasticsearch-operator/{}'.format(i))
+
+        es = self.harness.charm._get_es_client()
+        # the cluster already has the ideal number of nodes
+        mock_mmn.return_value = 2
+        self.harness.charm.on.update_status.emit()
+        es.cluster.put_settings.assert_not_called()
+
+        # the setting is changed outside of the charm
+        mock_mmn.return_value = 1
+        self.harness.charm.on.update_status.emit()
+        es.cluster.put_settings.assert_called_once_with(
+            body={'persistent': {'discovery.zen.minimum_master_nodes': 2}})
+
+    @mock.patch('charm.ElasticsearchOperatorCharm.num_es_nodes', new_callable=mock.PropertyMock)
+    def test_dynamic_settings_are_reapplied_after_regaining_leadership(self, mock_es_nodes):
+        self.harness.set_leader(True)
+        self.harness.update_config(MINIMAL_CONFIG.copy())
+
+        num_units = 3
+        mock_es_nodes.return_value = num_units
+        rel_id = self.harness.add_relation('elasticsearch', 'elasticsearch')
+        for i in range(1, num_units):
+            self.harness.add_relation_unit(rel_id, 'elasticsearch-operator/{}'.format(i))
+
+        es = self.harness.charm._get_es_client()
+        self.harness.charm.on.update_status.emit()
+        es.cluster.put_settings.assert_called_once()
+
+        # another leader may have changed the settings in the meantime
+        self.harness.set_leader(False)
+        self.harness.set_leader(True)
+        rel = self.harness.model.get_relation('elasticsearch')
+        self.harness.charm.on.elasticsearch_relation_changed.emit(rel)
+        self.assertEqual(es.cluster.put_settings.call_count, 2)
+
+    @mock.patch('charm.ElasticsearchOperatorCharm.num_es_nodes', new_callable=mock.PropertyMock)
+    def test_dynamic_settings_are_not_recorded_after_failed_read(self, mock_es_nodes):
+        # read the cluster settings through the patched client
+        self.mock_current_mmn.stop()
+        self.harness.set_leader(True)
+        self.harness.update_config(MINIMAL_CONFIG.copy())
+
+        num_units = 2
+        mock_es_nodes.return_value = num_units
+        rel_id = self.harness.add_relation('elasticsearch', 'elasticsearch')
+        self.harness.add_relation_unit(rel_id, 'elasticsearch-operator/1')
+
+        # neither reading nor writing the settings succeeds
+        es = self.harness.charm._get_es_client()
+        error = RequestError(400, 'error', {})
+        es.cluster.get_settings.side_effect = error
+        es.cluster.put_settings.side_effect = error
+        self.harness.charm.on.update_status.emit()
+        es.cluster.get_settings.assert_called_with(
+            filter_path='persistent.discovery.zen.minimum_master_nodes')
+        self.assertEqual(self.harness.charm.unit.status,
+                         BlockedStatus('Failure updating cluster-wide settings'))
+        self.assertEqual(self.harness.charm._stored.last_dynamic_settings, '')
+
+        # the settings are read again and corrected on the next relation change
+        mmn_settings = {'persistent': {'discovery': {'zen': {'minimum_master_nodes': '3'}}}}
+        es.cluster.get_settings.side_effect = None
+        es.cluster.get_settings.return_value = mmn_settings
+        es.cluster.put_settings.side_effect = None
+        rel = self.harness.model.get_relation('elasticsearch')
+        self.harness.charm.on.elasticsearch_relation_changed.emit(rel)
+        es.cluster.put_settings.assert_called_with(
+            body={'persistent': {'discovery.zen.minimum_master_nodes': 1}})
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+    @mock.patch('charm.ElasticsearchOperatorCharm.ingress_address', new_callable=mock.PropertyMock)
+    @mock.patch('charm.Elasticsearch')
+    def test_es_client_is_reused_until_host_changes(self, mock_es, mock_ingress_address):
+        # use the real client factory instead of the one patched in setUp
+        self.mock_es_client.stop()
+        mock_ingress_address.return_value = '10.0.0.1'
+        self.harness.update_config(MINIMAL_CONFIG.copy())
+
+        es = self.harness.charm._get_es_client()
+        self.assertIs(es, self.harness.charm._get_es_client())
+        mock_es.assert_called_once()
+
+        new_port_config = MINIMAL_CONFIG.copy()
+        new_port_config['port'] = 9201
+        self.harness.update_config(new_port_config)
+        self.harness.charm._get_es_client()
+        self.assertEqual(mock_es.call_count, 2)
+        self.assertEqual(mock_es.call_args[0][0], '10.0.0.1:9201')
+
+
+def config_files(pod_spec):
     # get elasticsearch container from pod spec
     containers = pod_spec['containers']
-    elspod = next(filter(lambda obj: obj.get('name') == 'elasticsearch',
-                         containers), None)
+    elspod = next((obj for obj in containers if obj.get('name') == 'elasticsearch'), None)
     # get mounted configuration volume from container spec
     elsvolumes = elspod['volumeConfig']
-    elsconfig = next(filter(lambda obj: obj.get('name') == 'config',
-                            elsvolumes), None)
+    elsconfig = next((obj for obj in elsvolumes if obj.get('name') == 'config'), None)
+    # index the configuation files of the configuation volume by path,
+    # so several files of the same pod spec can be looked up cheaply
+    return {obj.get('path'): obj for obj in elsconfig['files']}
+
+
+def config_file(pod_spec, file):
     # get elasticsearch configuation file from configuation volume
-    elsfiles = elsconfig['files']
-    conf_file = next(filter(lambda obj: obj.get('path') == file,
-                            elsfiles), None)
-    return conf_file
+    return config_files(pod_spec).get(file)
 
 
 def elastic_config(pod_spec):
     elsconfig = config_file(pod_spec, 'elasticsearch.yml')
 
     # load configuation yaml
-    config_dict = yaml.safe_load(elsconfig['content'])
+    config_dict = load_yaml(elsconfig['content'])
     return config_dict
+
+
+@functools.lru_cache(maxsize=16)
+def load_yaml(content):
+    # parsed documents are shared between callers, tests must not modify them;
+    # keyed on the content itself so that a cached result is never stale
+    return yaml.load(content, Loader=charm._YAML_LOADER)